@@ -1,28 +1,55 @@
 """
 DeepSeek AI 股票筛选模块
 """
-from openai import OpenAI
-from typing import List, Dict, Optional
+from openai import OpenAI, APITimeoutError
+from typing import List, Dict, Optional, Tuple
 import json
+import time
 from .config import get_settings
+from .budget import MinuteBudget, TokenBudget, estimate_tokens
+from .local_ranker import LocalStockRanker
 
 
 class AIStockScreener:
     """AI股票筛选器"""
 
+    # 提示中最多列出的股票数
+    MAX_PROMPT_STOCKS = 100
+    # 输出 token 估算：整体分析与风险提示 + 每只股票的评分与理由
+    OUTPUT_TOKENS_BASE = 400
+    OUTPUT_TOKENS_PER_RESULT = 120
+
     def __init__(self):
         settings = get_settings()
-        self.client = OpenAI(
-            api_key=settings.deepseek_api_key,
-            base_url=settings.deepseek_base_url
-        )
+        # 未配置 API Key 时不创建客户端，筛选直接使用本地排序
+        self.client = None
+        if settings.deepseek_api_key:
+            self.client = OpenAI(
+                api_key=settings.deepseek_api_key,
+                base_url=settings.deepseek_base_url,
+                timeout=settings.llm_timeout,
+                max_retries=0  # 超时直接降级，不重试以控制尾延迟
+            )
         self.model = "deepseek-chat"
+        self.fallback_enabled = settings.local_fallback_enabled
+        self.local_ranker = LocalStockRanker()
+        self.budget = MinuteBudget(
+            max_calls=settings.llm_max_calls_per_minute,
+            max_latency=settings.llm_max_latency_per_minute
+        )
+        self.token_budget = TokenBudget(
+            per_minute=settings.llm_tokens_per_minute,
+            per_client_per_minute=settings.llm_client_tokens_per_minute
+        )
+        self.max_output_tokens = settings.llm_max_output_tokens
+        self.max_tokens_per_request = settings.llm_max_tokens_per_request
 
     def screen_stocks(
         self,
         stocks: List[Dict],
         criteria: str,
-        max_results: int = 10
+        max_results: int = 10,
+        client_id: Optional[str] = None
     ) -> Dict:
         """
         使用AI筛选股票
@@ -30,39 +57,144 @@ class AIStockScreener:
             stocks: 股票列表
             criteria: 筛选条件（自然语言）
             max_results: 最多返回结果数
+            client_id: 客户端标识，用于按客户端统计 token 用量
         Returns:
             筛选结果
         """
+        if self.client is None:
+            return self._fallback(stocks, criteria, max_results, "未配置 DeepSeek API Key")
+
+        budget_reason = self.budget.exceeded_reason()
+        if budget_reason:
+            return self._fallback(stocks, criteria, max_results, budget_reason)
+
+        # 按 token 预算确定候选数量与输出上限
+        plan = self._plan_tokens(stocks, criteria, max_results, client_id)
+        if plan is None:
+            return self._fallback(stocks, criteria, max_results, "本分钟 token 预算不足")
+        candidates, max_results, max_tokens = plan
+
         try:
             # 构建系统提示
             system_prompt = self._build_system_prompt()
 
             # 构建用户提示
-            user_prompt = self._build_user_prompt(stocks, criteria, max_results)
+            user_prompt = self._build_user_prompt(stocks[:candidates], criteria, max_results)
+
+            # 预留 token，调用结束后按实际用量结算
+            prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+            reservation = self.token_budget.try_reserve(prompt_tokens + max_tokens, client_id)
+            if reservation is None:
+                return self._fallback(stocks, criteria, max_results, "本分钟 token 预算不足")
 
             # 调用DeepSeek API
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=4000
-            )
+            start = time.monotonic()
+            try:
+                response = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    temperature=0.3,
+                    max_tokens=max_tokens
+                )
+            except Exception:
+                self.token_budget.settle(reservation, prompt_tokens)
+                raise
+            finally:
+                self.budget.record(time.monotonic() - start)
+            self._settle_usage(reservation, response)
 
             # 解析响应
             result = self._parse_response(response.choices[0].message.content)
+            if not result["success"]:
+                return self._fallback(stocks, criteria, max_results, result["error"], result)
+            result["candidates_analyzed"] = candidates
             return result
 
+        except APITimeoutError:
+            return self._fallback(stocks, criteria, max_results, "AI调用超时")
         except Exception as e:
-            return {
+            return self._fallback(stocks, criteria, max_results, str(e))
+
+    def _plan_tokens(
+        self,
+        stocks: List[Dict],
+        criteria: str,
+        max_results: int,
+        client_id: Optional[str]
+    ) -> Optional[Tuple[int, int, int]]:
+        """
+        在单次请求与每分钟 token 预算内确定候选股票数、返回数和输出上限
+        Returns:
+            (候选股票数, 返回数, 输出 token 上限)，预算不足时返回 None
+        """
+        entries = self._simplify_stocks(stocks[:self.MAX_PROMPT_STOCKS])
+        if not entries:
+            return None
+
+        def output_tokens(results: int) -> int:
+            needed = self.OUTPUT_TOKENS_BASE + self.OUTPUT_TOKENS_PER_RESULT * results
+            return min(self.max_output_tokens, needed) if self.max_output_tokens else needed
+
+        max_results = max(1, min(max_results, len(entries)))
+        limits = [self.max_tokens_per_request] if self.max_tokens_per_request else []
+        remaining = self.token_budget.remaining(client_id)
+        if remaining is not None:
+            limits.append(remaining)
+        if not limits:
+            return len(entries), max_results, output_tokens(max_results)
+
+        fixed = (
+            estimate_tokens(self._build_system_prompt())
+            + estimate_tokens(self._build_user_prompt([], criteria, max_results))
+        )
+        per_stock = estimate_tokens(json.dumps(entries, ensure_ascii=False, indent=2)) / len(entries)
+
+        room = min(limits) - fixed - output_tokens(max_results)
+        candidates = min(len(entries), int(room // per_stock)) if room > 0 else 0
+        if candidates < 1:
+            return None
+
+        # 候选数不足时相应减少返回数与输出上限
+        max_results = min(max_results, candidates)
+        return candidates, max_results, output_tokens(max_results)
+
+    def _settle_usage(self, reservation: List, response):
+        """按接口返回的实际用量结算预留的 token"""
+        usage = getattr(response, "usage", None)
+        if usage is not None and usage.total_tokens:
+            self.token_budget.settle(reservation, usage.total_tokens)
+
+    def _fallback(
+        self,
+        stocks: List[Dict],
+        criteria: str,
+        max_results: int,
+        reason: str,
+        failed_result: Optional[Dict] = None
+    ) -> Dict:
+        """
+        AI不可用时切换到本地排序
+        Args:
+            reason: 切换原因
+            failed_result: 未启用本地排序时返回的失败结果
+        Returns:
+            筛选结果
+        """
+        if not self.fallback_enabled:
+            return failed_result or {
                 "success": False,
-                "error": str(e),
+                "error": reason,
                 "stocks": [],
                 "analysis": "AI筛选失败，请检查API配置或稍后重试"
             }
 
+        result = self.local_ranker.screen_stocks(stocks, criteria, max_results, reason=reason)
+        result["fallback_reason"] = reason
+        return result
+
     def _build_system_prompt(self) -> str:
         """构建系统提示"""
         return """你是一位专业的A股市场分析师，精通股票筛选和投资分析。
@@ -103,19 +235,7 @@ class AIStockScreener:
         max_results: int
     ) -> str:
         """构建用户提示"""
-        # 简化股票数据，只保留关键信息
-        stocks_data = []
-        for stock in stocks:
-            stocks_data.append({
-                "代码": stock.get("code"),
-                "名称": stock.get("name"),
-                "最新价": stock.get("price"),
-                "涨跌幅": stock.get("change_pct"),
-                "换手率": stock.get("turnover_rate"),
-                "市盈率": stock.get("pe_dynamic"),
-                "市净率": stock.get("pb"),
-                "总市值": stock.get("market_cap"),
-            })
+        stocks_data = self._simplify_stocks(stocks)
 
         prompt = f"""
 请根据以下条件筛选股票：
@@ -125,7 +245,7 @@ class AIStockScreener:
 
 【股票数据】
 共{len(stocks_data)}只股票
-{json.dumps(stocks_data[:100], ensure_ascii=False, indent=2)}
+{json.dumps(stocks_data[:self.MAX_PROMPT_STOCKS], ensure_ascii=False, indent=2)}
 
 【要求】
 - 请从以上股票中选出最符合条件的 {max_results} 只股票
@@ -137,6 +257,23 @@ class AIStockScreener:
 """
         return prompt
 
+    @staticmethod
+    def _simplify_stocks(stocks: List[Dict]) -> List[Dict]:
+        """简化股票数据，只保留关键信息"""
+        stocks_data = []
+        for stock in stocks:
+            stocks_data.append({
+                "代码": stock.get("code"),
+                "名称": stock.get("name"),
+                "最新价": stock.get("price"),
+                "涨跌幅": stock.get("change_pct"),
+                "换手率": stock.get("turnover_rate"),
+                "市盈率": stock.get("pe_dynamic"),
+                "市净率": stock.get("pb"),
+                "总市值": stock.get("market_cap"),
+            })
+        return stocks_data
+
     def _parse_response(self, response_text: str) -> Dict:
         """解析AI响应"""
         try:
@@ -156,7 +293,8 @@ class AIStockScreener:
                 "success": True,
                 "stocks": result.get("stocks", []),
                 "analysis": result.get("analysis", ""),
-                "risk_warning": result.get("risk_warning", "投资有风险，入市需谨慎")
+                "risk_warning": result.get("risk_warning", "投资有风险，入市需谨慎"),
+                "engine": "deepseek"
             }
         except json.JSONDecodeError:
             # 如果解析失败，返回原始文本
@@ -168,15 +306,24 @@ class AIStockScreener:
                 "risk_warning": "投资有风险，入市需谨慎"
             }
 
-    def chat_about_stock(self, stock_code: str, question: str) -> str:
+    def chat_about_stock(
+        self,
+        stock_code: str,
+        question: str,
+        client_id: Optional[str] = None
+    ) -> str:
         """
         关于特定股票的问答
         Args:
             stock_code: 股票代码
             question: 用户问题
+            client_id: 客户端标识，用于按客户端统计 token 用量
         Returns:
             AI回答
         """
+        if self.client is None:
+            return "AI回答失败: 未配置 DeepSeek API Key"
+
         try:
             prompt = f"""
 用户问题：{question}
@@ -185,6 +332,11 @@ class AIStockScreener:
 请基于专业知识回答用户关于该股票的问题。
 注意：这只是分析参考，不构成投资建议。
 """
+            max_tokens = 1000
+            reservation = self.token_budget.try_reserve(estimate_tokens(prompt) + max_tokens, client_id)
+            if reservation is None:
+                return "AI回答失败: 本分钟 token 预算不足，请稍后重试"
+
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=[
@@ -192,8 +344,9 @@ class AIStockScreener:
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.7,
-                max_tokens=1000
+                max_tokens=max_tokens
             )
+            self._settle_usage(reservation, response)
 
             return response.choices[0].message.content
 
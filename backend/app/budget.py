@@ -0,0 +1,138 @@
+"""
+AI 调用预算模块
+按滑动一分钟窗口统计调用次数、耗时与 token 用量，超出预算时由调用方切换到本地排序
+"""
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的 token 数
+    中文字符约 0.6 token/字，其他字符约 0.3 token/字符
+    """
+    cjk = sum(1 for ch in text if "\u4e00" <= ch <= "\u9fff")
+    return int(cjk * 0.6 + (len(text) - cjk) * 0.3) + 1
+
+
+class MinuteBudget:
+    """每分钟调用预算"""
+
+    WINDOW = 60.0
+
+    def __init__(self, max_calls: int = 0, max_latency: float = 0.0):
+        """
+        Args:
+            max_calls: 每分钟最多调用次数，0 表示不限制
+            max_latency: 每分钟累计调用耗时上限（秒），0 表示不限制
+        """
+        self.max_calls = max_calls
+        self.max_latency = max_latency
+        self._lock = threading.Lock()
+        self._calls = deque()  # (结束时间, 耗时)
+
+    def _prune(self, now: float):
+        """移除窗口外的记录"""
+        while self._calls and now - self._calls[0][0] > self.WINDOW:
+            self._calls.popleft()
+
+    def exceeded_reason(self) -> Optional[str]:
+        """
+        检查当前窗口是否已超出预算
+        Returns:
+            超出时返回原因，否则返回 None
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            if self.max_calls and len(self._calls) >= self.max_calls:
+                return f"每分钟AI调用次数已达上限 {self.max_calls}"
+            if self.max_latency and sum(latency for _, latency in self._calls) >= self.max_latency:
+                return f"每分钟AI调用耗时已达上限 {self.max_latency:g} 秒"
+        return None
+
+    def record(self, latency: float):
+        """记录一次调用"""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            self._calls.append((now, latency))
+
+
+class TokenBudget:
+    """每分钟 token 预算（全局与单个客户端）"""
+
+    WINDOW = 60.0
+
+    def __init__(self, per_minute: int = 0, per_client_per_minute: int = 0):
+        """
+        Args:
+            per_minute: 全局每分钟 token 上限，0 表示不限制
+            per_client_per_minute: 单个客户端每分钟 token 上限，0 表示不限制
+        """
+        self.per_minute = per_minute
+        self.per_client_per_minute = per_client_per_minute
+        self._lock = threading.Lock()
+        self._entries = deque()  # [时间, 客户端, token 数]
+
+    def _prune(self, now: float):
+        """移除窗口外的记录"""
+        while self._entries and now - self._entries[0][0] > self.WINDOW:
+            self._entries.popleft()
+
+    def _remaining(self, client_id: Optional[str]) -> Optional[int]:
+        """计算可用 token 数（调用方需持有锁并已清理过期记录）"""
+        limits = []
+        if self.per_minute:
+            used = sum(entry[2] for entry in self._entries)
+            limits.append(self.per_minute - used)
+        if self.per_client_per_minute and client_id is not None:
+            used = sum(entry[2] for entry in self._entries if entry[1] == client_id)
+            limits.append(self.per_client_per_minute - used)
+        return max(0, min(limits)) if limits else None
+
+    def remaining(self, client_id: Optional[str] = None) -> Optional[int]:
+        """
+        当前窗口内可用的 token 数（取全局与客户端余量的较小值）
+        仅用于规划请求大小，实际占用须通过 try_reserve
+        Returns:
+            可用 token 数，均不限制时返回 None
+        """
+        with self._lock:
+            self._prune(time.monotonic())
+            return self._remaining(client_id)
+
+    def try_reserve(self, tokens: int, client_id: Optional[str] = None) -> Optional[List]:
+        """
+        调用前按估算值预留 token，检查与预留在同一把锁内完成，并发请求不会超出预算
+        Returns:
+            预留记录（调用结束后传给 settle），超出预算时返回 None
+        """
+        entry = [time.monotonic(), client_id, tokens]
+        with self._lock:
+            self._prune(entry[0])
+            remaining = self._remaining(client_id)
+            if remaining is not None and tokens > remaining:
+                return None
+            self._entries.append(entry)
+        return entry
+
+    def settle(self, entry: List, tokens: int):
+        """用实际用量替换预留值"""
+        with self._lock:
+            entry[2] = tokens
+
+    def usage(self) -> Dict:
+        """当前窗口内的 token 用量（仅汇总数据，不包含各客户端标识）"""
+        with self._lock:
+            self._prune(time.monotonic())
+            total = sum(entry[2] for entry in self._entries)
+            clients = len({entry[1] for entry in self._entries})
+        return {
+            "tokens_last_minute": total,
+            "active_clients": clients,
+            "per_minute_limit": self.per_minute,
+            "per_client_limit": self.per_client_per_minute
+        }
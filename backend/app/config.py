@@ -3,6 +3,7 @@
 """
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import List
 
 
 class Settings(BaseSettings):
@@ -11,6 +12,19 @@ class Settings(BaseSettings):
     # DeepSeek API
     deepseek_api_key: str = ""
     deepseek_base_url: str = "https://api.deepseek.com"
+    llm_timeout: float = 30.0  # 单次调用超时（秒）
+
+    # AI 预算，超出时切换到本地排序（0 表示不限制）
+    local_fallback_enabled: bool = True
+    llm_max_calls_per_minute: int = 30
+    llm_max_latency_per_minute: float = 300.0  # 每分钟累计调用耗时（秒）
+
+    # Token 预算（0 表示不限制）
+    # 计数保存在各 worker 进程内，多 worker 部署时总上限约为配置值 × worker 数
+    llm_max_output_tokens: int = 4000
+    llm_max_tokens_per_request: int = 16000
+    llm_tokens_per_minute: int = 200000
+    llm_client_tokens_per_minute: int = 40000
 
     # 应用设置
     app_host: str = "0.0.0.0"
@@ -20,6 +34,22 @@ class Settings(BaseSettings):
     # 股票筛选设置
     default_market: str = "A股"
     max_stocks_return: int = 50
+    max_stocks_to_analyze: int = 500
+    trusted_proxies: str = ""  # 可信反向代理IP（逗号分隔），仅信任其 X-Forwarded-For
+
+    # 行情快照（多个 worker 共享的内存映射文件）
+    snapshot_path: str = ""  # 为空时使用 /dev/shm 或系统临时目录
+    snapshot_ttl: int = 60  # 快照有效期（秒）
+
+    # 保存的筛选
+    saved_screens_file: str = "saved_screens.json"
+    screen_poll_interval: int = 15  # 检查行情快照版本的间隔（秒），版本变化时重算，0 表示不自动运行
+    screen_batch_concurrency: int = 3
+
+    @property
+    def trusted_proxy_list(self) -> List[str]:
+        """可信反向代理IP列表"""
+        return [ip.strip() for ip in self.trusted_proxies.split(",") if ip.strip()]
 
     class Config:
         env_file = ".env"
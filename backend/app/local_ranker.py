@@ -0,0 +1,173 @@
+"""
+本地多因子排序模块
+AI 不可用或超出预算时使用，基于行情快照字段做确定性的向量化打分
+"""
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+
+
+# 因子 -> 触发加权的关键词
+FACTOR_KEYWORDS = {
+    "value": ["市盈率", "市净率", "估值", "低估", "价值", "pe", "pb", "便宜", "银行"],
+    "momentum": ["涨", "动量", "强势", "趋势", "突破", "上升"],
+    "liquidity": ["换手", "成交", "活跃", "流动性", "放量"],
+    "size": ["市值", "大盘", "蓝筹", "龙头", "白马", "小盘"],
+}
+
+FACTOR_NAMES = {
+    "value": "估值",
+    "momentum": "动量",
+    "liquidity": "流动性",
+    "size": "规模",
+}
+
+
+class LocalStockRanker:
+    """本地多因子股票排序器"""
+
+    def __init__(self, keyword_weight: float = 2.0):
+        """
+        Args:
+            keyword_weight: 筛选条件提到某因子时该因子的权重
+        """
+        self.keyword_weight = keyword_weight
+
+    def screen_stocks(
+        self,
+        stocks: List[Dict],
+        criteria: str,
+        max_results: int = 10,
+        reason: Optional[str] = None
+    ) -> Dict:
+        """
+        使用本地因子模型筛选股票，返回结构与 AIStockScreener.screen_stocks 一致
+        Args:
+            stocks: 股票列表
+            criteria: 筛选条件（自然语言，仅用于调整因子权重）
+            max_results: 最多返回结果数
+            reason: 未使用AI的原因，写入分析说明
+        Returns:
+            筛选结果
+        """
+        if not stocks:
+            return {
+                "success": False,
+                "error": "没有可供排序的股票数据",
+                "stocks": [],
+                "analysis": "",
+                "engine": "local"
+            }
+
+        df = pd.DataFrame(stocks)
+        factors = self._factor_scores(df, prefer_small="小盘" in (criteria or ""))
+        weights = self._factor_weights(criteria)
+
+        total = sum(factors[name] * weight for name, weight in weights.items())
+        df["score"] = (total / sum(weights.values()) * 100).round(1)
+        top = df.sort_values("score", ascending=False, kind="stable").head(max_results)
+
+        results = []
+        for idx, row in top.iterrows():
+            results.append({
+                "code": row.get("code"),
+                "name": row.get("name"),
+                "score": float(row["score"]),
+                "reason": self._build_reason(
+                    row,
+                    {name: factors[name][idx] for name in weights},
+                    weights,
+                    len(df)
+                )
+            })
+
+        emphasized = [FACTOR_NAMES[name] for name, w in weights.items() if w > 1]
+        focus = "、".join(emphasized) if emphasized else "估值、动量、流动性、规模均衡"
+        prefix = f"本次未使用AI（{reason}），" if reason else ""
+        return {
+            "success": True,
+            "stocks": results,
+            "analysis": f"{prefix}以下结果由本地多因子模型生成（侧重：{focus}），"
+                        f"共评估 {len(df)} 只股票，仅按行情快照数据打分，未理解筛选条件的全部含义。",
+            "risk_warning": "本地模型仅基于当日行情数据，未考虑基本面变化与行业因素。投资有风险，入市需谨慎",
+            "engine": "local"
+        }
+
+    @staticmethod
+    def _rank(series: pd.Series, valid: pd.Series = None) -> pd.Series:
+        """百分位排名（0-1），只在有效值之间排名，无效值记为 0"""
+        if valid is not None:
+            series = series.where(valid)
+        return series.rank(pct=True).fillna(0.0)
+
+    def _factor_scores(self, df: pd.DataFrame, prefer_small: bool = False) -> Dict[str, pd.Series]:
+        """
+        计算各因子得分（0-1）
+        Args:
+            prefer_small: 偏好小盘股时规模因子反向
+        """
+        def column(name: str) -> pd.Series:
+            if name not in df:
+                return pd.Series(0.0, index=df.index)
+            return pd.to_numeric(df[name], errors="coerce").fillna(0.0)
+
+        pe = column("pe_dynamic")
+        pb = column("pb")
+        # 亏损或缺失的估值不参与排名
+        value = (self._rank(-pe, pe > 0) + self._rank(-pb, pb > 0)) / 2
+
+        momentum = self._rank(column("change_pct"))
+
+        liquidity = (self._rank(column("turnover_rate")) + self._rank(column("amount"))) / 2
+
+        market_cap = column("market_cap")
+        has_cap = market_cap > 0
+        size = self._rank(np.log1p(market_cap.clip(lower=0)), has_cap)
+        if prefer_small:
+            # 缺失市值的股票仍记为 0
+            size = (1 - size).where(has_cap, 0.0)
+
+        return {
+            "value": value,
+            "momentum": momentum,
+            "liquidity": liquidity,
+            "size": size,
+        }
+
+    def _factor_weights(self, criteria: str) -> Dict[str, float]:
+        """根据筛选条件中的关键词调整因子权重"""
+        text = (criteria or "").lower()
+        weights = {}
+        for name, keywords in FACTOR_KEYWORDS.items():
+            weights[name] = self.keyword_weight if any(k in text for k in keywords) else 1.0
+        return weights
+
+    @staticmethod
+    def _build_reason(
+        row: pd.Series,
+        factor_values: Dict[str, float],
+        weights: Dict[str, float],
+        total: int
+    ) -> str:
+        """生成模板化的选股理由"""
+        def valuation(value: float, digits: int) -> str:
+            # 与 _factor_scores 一致，非正值不参与估值排名
+            return f"{value:.{digits}f}" if value > 0 else "亏损/无数据"
+
+        templates = {
+            "value": f"市盈率 {valuation(row.get('pe_dynamic', 0), 1)}，市净率 {valuation(row.get('pb', 0), 2)}",
+            "momentum": f"涨跌幅 {row.get('change_pct', 0):.2f}%",
+            "liquidity": f"换手率 {row.get('turnover_rate', 0):.2f}%，成交额 {row.get('amount', 0) / 1e8:.2f} 亿",
+            "size": f"总市值 {row.get('market_cap', 0) / 1e8:.1f} 亿",
+        }
+        # 按对总分的贡献排序，取前两项
+        contributions = sorted(
+            factor_values,
+            key=lambda name: factor_values[name] * weights[name],
+            reverse=True
+        )
+        parts = []
+        for name in contributions[:2]:
+            top_pct = min(100, round((1 - factor_values[name]) * 100 + 100 / total))
+            parts.append(f"{FACTOR_NAMES[name]}因子排名前 {top_pct}%（{templates[name]}）")
+        return "；".join(parts)
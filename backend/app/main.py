@@ -1,13 +1,14 @@
 """
 FastAPI 主应用
 """
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 from .config import get_settings
 from .stock_data import StockDataFetcher
 from .ai_screener import AIStockScreener
+from .saved_screens import SavedScreenStore, ScreenScheduler
 
 # 创建FastAPI应用
 app = FastAPI(
@@ -29,14 +30,30 @@ app.add_middleware(
 settings = get_settings()
 stock_fetcher = StockDataFetcher()
 ai_screener = AIStockScreener()
+screen_store = SavedScreenStore(settings.saved_screens_file)
+screen_scheduler = ScreenScheduler(
+    store=screen_store,
+    stock_fetcher=stock_fetcher,
+    ai_screener=ai_screener,
+    interval=settings.screen_poll_interval,
+    concurrency=settings.screen_batch_concurrency
+)
 
 
 # 数据模型
 class ScreenRequest(BaseModel):
     """股票筛选请求"""
     criteria: str
-    max_results: int = 10
-    max_stocks_to_analyze: int = 100
+    max_results: int = Field(10, ge=1, le=settings.max_stocks_return)
+    max_stocks_to_analyze: int = Field(100, ge=1, le=settings.max_stocks_to_analyze)
+
+
+class SavedScreenRequest(BaseModel):
+    """保存筛选请求"""
+    name: str
+    criteria: str
+    max_results: int = Field(10, ge=1, le=settings.max_stocks_return)
+    max_stocks_to_analyze: int = Field(100, ge=1, le=settings.max_stocks_to_analyze)
 
 
 class ChatRequest(BaseModel):
@@ -45,6 +62,36 @@ class ChatRequest(BaseModel):
     question: str
 
 
+@app.on_event("startup")
+async def start_scheduler():
+    """启动保存筛选的后台重算"""
+    screen_scheduler.start()
+
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    """停止保存筛选的后台重算"""
+    await screen_scheduler.stop()
+
+
+def get_client_id(http_request: Request) -> str:
+    """
+    客户端标识：使用来源IP
+    仅当请求来自 TRUSTED_PROXIES 中的代理时才读取 X-Forwarded-For。
+    代理会把上一跳地址追加到末尾，因此从右向左跳过可信代理，取第一个非代理地址；
+    靠左的条目可由客户端任意伪造，不予采用
+    """
+    host = http_request.client.host if http_request.client else "unknown"
+    trusted = settings.trusted_proxy_list
+    if host not in trusted:
+        return host
+    forwarded = [ip.strip() for ip in http_request.headers.get("x-forwarded-for", "").split(",")]
+    for ip in reversed(forwarded):
+        if ip and ip not in trusted:
+            return ip
+    return host
+
+
 # API 路由
 @app.get("/")
 async def root():
@@ -55,6 +102,7 @@ async def root():
         "endpoints": {
             "股票列表": "/api/stocks",
             "AI筛选": "/api/screen",
+            "保存的筛选": "/api/screens",
             "股票问答": "/api/chat"
         }
     }
@@ -77,7 +125,7 @@ async def get_stocks(limit: int = 100):
 
 
 @app.post("/api/screen")
-async def screen_stocks(request: ScreenRequest):
+async def screen_stocks(request: ScreenRequest, http_request: Request):
     """
     AI 股票筛选
     """
@@ -92,7 +140,8 @@ async def screen_stocks(request: ScreenRequest):
         result = ai_screener.screen_stocks(
             stocks=stocks,
             criteria=request.criteria,
-            max_results=request.max_results
+            max_results=request.max_results,
+            client_id=get_client_id(http_request)
         )
 
         return result
@@ -101,15 +150,89 @@ async def screen_stocks(request: ScreenRequest):
         raise HTTPException(status_code=500, detail=f"筛选失败: {str(e)}")
 
 
+@app.post("/api/screens")
+def create_saved_screen(request: SavedScreenRequest):
+    """
+    保存筛选条件，后续随行情刷新自动重算
+    """
+    screen = screen_store.create(
+        name=request.name,
+        criteria=request.criteria,
+        max_results=request.max_results,
+        max_stocks_to_analyze=request.max_stocks_to_analyze
+    )
+    return {"success": True, "screen": screen}
+
+
+@app.get("/api/screens")
+def list_saved_screens():
+    """
+    列出保存的筛选
+    """
+    screens = screen_store.list()
+    return {"success": True, "count": len(screens), "screens": screens}
+
+
+@app.delete("/api/screens/{screen_id}")
+def delete_saved_screen(screen_id: str):
+    """
+    删除保存的筛选
+    """
+    if not screen_store.delete(screen_id):
+        raise HTTPException(status_code=404, detail="筛选不存在")
+    return {"success": True}
+
+
+@app.get("/api/screens/{screen_id}/latest")
+def get_saved_screen_latest(screen_id: str):
+    """
+    获取保存筛选的最近一次重算结果
+    """
+    screen = screen_store.get(screen_id)
+    if screen is None:
+        raise HTTPException(status_code=404, detail="筛选不存在")
+
+    latest = screen_store.get_latest(screen_id) or {}
+    if "result" not in latest:
+        detail = "暂无重算结果，请等待下次行情刷新"
+        if latest.get("last_error"):
+            detail = f"{detail}（最近一次重算失败: {latest['last_error']}）"
+        raise HTTPException(status_code=404, detail=detail)
+
+    response = {
+        "screen": screen,
+        "evaluated_at": latest["evaluated_at"],
+        **latest["result"]
+    }
+    # 上次成功之后的重算失败时，仍返回上次成功的结果，并附带失败信息
+    if latest.get("last_error"):
+        response["last_attempt_at"] = latest["last_attempt_at"]
+        response["last_error"] = latest["last_error"]
+    return response
+
+
+@app.post("/api/screens/run")
+async def run_saved_screens():
+    """
+    立即重算所有保存的筛选（行情快照过期时先刷新）
+    """
+    try:
+        summary = await screen_scheduler.run_batch()
+        return {"success": True, **summary}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"重算失败: {str(e)}")
+
+
 @app.post("/api/chat")
-async def chat_about_stock(request: ChatRequest):
+async def chat_about_stock(request: ChatRequest, http_request: Request):
     """
     关于股票的问答
     """
     try:
         answer = ai_screener.chat_about_stock(
             stock_code=request.stock_code,
-            question=request.question
+            question=request.question,
+            client_id=get_client_id(http_request)
         )
         return {
             "success": True,
@@ -121,12 +244,19 @@ async def chat_about_stock(request: ChatRequest):
         raise HTTPException(status_code=500, detail=f"问答失败: {str(e)}")
 
 
+@app.get("/api/usage")
+async def get_usage():
+    """最近一分钟的 token 用量（本 worker 的汇总数据）"""
+    return {"success": True, **ai_screener.token_budget.usage()}
+
+
 @app.get("/api/health")
 async def health_check():
     """健康检查"""
     return {
         "status": "healthy",
-        "api_configured": bool(settings.deepseek_api_key)
+        "api_configured": bool(settings.deepseek_api_key),
+        "local_fallback": settings.local_fallback_enabled
     }
 
 
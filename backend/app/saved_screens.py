@@ -0,0 +1,324 @@
+"""
+保存的筛选条件与批量重算模块
+行情快照每更新一个版本，统一重算所有保存的筛选，结果带时间戳持久化，供接口直接读取
+"""
+import asyncio
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+# 文件锁仅在类 Unix 系统可用，不可用时只能单 worker 部署
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def screen_key(screen: Dict) -> Tuple[str, int, int]:
+    """
+    生成筛选的去重键
+    条件文本仅做空白归一化，参数相同的筛选共享一次AI调用
+    """
+    criteria = " ".join(str(screen.get("criteria", "")).split())
+    return (
+        criteria,
+        int(screen.get("max_results", 10)),
+        int(screen.get("max_stocks_to_analyze", 100)),
+    )
+
+
+class SavedScreenStore:
+    """
+    保存的筛选存储（JSON文件持久化）
+    多个 worker 共享同一文件，每次操作都在文件锁内重新读取，不在进程内缓存
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _open(self, write: bool = False):
+        """
+        在线程锁与进程间文件锁内读取数据，write 为 True 时退出前写回
+        """
+        with self._lock, open(f"{self.path}.lock", "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            data = self._load()
+            yield data
+            if write:
+                self._save(data)
+
+    def _load(self) -> Dict:
+        """从文件加载"""
+        data = {"screens": {}, "results": {}, "errors": {}}
+        if not os.path.exists(self.path):
+            return data
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data.update(json.load(f))
+        except Exception as e:
+            print(f"加载保存的筛选失败: {e}")
+        return data
+
+    def _save(self, data: Dict):
+        """写入文件（先写临时文件再替换，避免写到一半被读取）"""
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def create(
+        self,
+        name: str,
+        criteria: str,
+        max_results: int = 10,
+        max_stocks_to_analyze: int = 100
+    ) -> Dict:
+        """新建保存的筛选"""
+        screen = {
+            "id": uuid.uuid4().hex[:12],
+            "name": name,
+            "criteria": criteria,
+            "max_results": max_results,
+            "max_stocks_to_analyze": max_stocks_to_analyze,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        with self._open(write=True) as data:
+            data["screens"][screen["id"]] = screen
+        return screen
+
+    def list(self) -> List[Dict]:
+        """列出所有保存的筛选"""
+        with self._open() as data:
+            return list(data["screens"].values())
+
+    def get(self, screen_id: str) -> Optional[Dict]:
+        """获取单个保存的筛选"""
+        with self._open() as data:
+            return data["screens"].get(screen_id)
+
+    def delete(self, screen_id: str) -> bool:
+        """删除保存的筛选及其结果"""
+        with self._open(write=True) as data:
+            if screen_id not in data["screens"]:
+                return False
+            del data["screens"][screen_id]
+            data["results"].pop(screen_id, None)
+            data["errors"].pop(screen_id, None)
+            return True
+
+    def get_latest(self, screen_id: str) -> Optional[Dict]:
+        """
+        获取最近一次成功的重算结果，以及之后失败的重算信息
+        Returns:
+            {"evaluated_at", "result"}（尚无成功结果时不含这两项）
+            + {"last_attempt_at", "last_error"}（最近一次重算失败时），均无时返回 None
+        """
+        with self._open() as data:
+            latest = dict(data["results"].get(screen_id) or {})
+            latest.update(data["errors"].get(screen_id) or {})
+            return latest or None
+
+    def save_results(self, outcomes: Dict[str, Dict], evaluated_at: str):
+        """
+        批量写入重算结果（跳过期间已被删除的筛选）
+        成功时替换最近结果，失败时只记录错误，保留上一次成功的结果
+        Args:
+            outcomes: 筛选ID -> 筛选结果
+            evaluated_at: 重算时间
+        """
+        with self._open(write=True) as data:
+            for screen_id, outcome in outcomes.items():
+                if screen_id not in data["screens"]:
+                    continue
+                if outcome.get("success"):
+                    data["results"][screen_id] = {
+                        "screen_id": screen_id,
+                        "evaluated_at": evaluated_at,
+                        "result": outcome
+                    }
+                    data["errors"].pop(screen_id, None)
+                else:
+                    data["errors"][screen_id] = {
+                        "last_attempt_at": evaluated_at,
+                        "last_error": outcome.get("error") or "重算失败"
+                    }
+
+
+class ScreenScheduler:
+    """保存筛选的批量重算调度器"""
+
+    def __init__(
+        self,
+        store: SavedScreenStore,
+        stock_fetcher,
+        ai_screener,
+        interval: int = 15,
+        concurrency: int = 3
+    ):
+        """
+        Args:
+            store: 保存的筛选存储
+            stock_fetcher: 股票数据获取器
+            ai_screener: AI筛选器
+            interval: 检查行情快照版本的间隔（秒），0 表示不自动运行
+            concurrency: 同时进行的AI调用数上限
+        """
+        self.store = store
+        self.stock_fetcher = stock_fetcher
+        self.ai_screener = ai_screener
+        self.interval = interval
+        self.concurrency = max(1, concurrency)
+        self._task: Optional[asyncio.Task] = None
+        self._batch_lock = asyncio.Lock()
+        self._leader_file = None
+        self._last_version: Optional[int] = None
+
+    def _try_lock(self, path: str):
+        """
+        尝试取得进程间文件锁（非阻塞）
+        Returns:
+            成功时返回持有锁的文件对象，锁被其他进程占用时返回 None
+        """
+        lock_file = open(path, "w")
+        if fcntl is None:
+            return lock_file
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _is_leader(self) -> bool:
+        """多个 worker 中只有持有调度锁的一个运行定时任务，持有者退出后由其他 worker 接替"""
+        if self._leader_file is None:
+            self._leader_file = self._try_lock(f"{self.store.path}.scheduler.lock")
+        return self._leader_file is not None
+
+    async def run_batch(self) -> Dict:
+        """
+        读取当前行情快照（过期时刷新）并重算所有保存的筛选
+        Returns:
+            本次运行摘要，其他 worker 正在运行时返回 skipped
+        """
+        async with self._batch_lock:
+            batch_file = self._try_lock(f"{self.store.path}.batch.lock")
+            if batch_file is None:
+                return {"skipped": True, "screens": 0, "evaluations": 0, "evaluated_at": None}
+            try:
+                return await self._run_batch()
+            finally:
+                batch_file.close()
+
+    async def _run_batch(self) -> Dict:
+        """批量重算（调用方已持有批次锁）"""
+        loop = asyncio.get_running_loop()
+
+        # 存储读写会等待文件锁，放到线程池中执行，不阻塞事件循环
+        screens = await loop.run_in_executor(None, self.store.list)
+        if not screens:
+            return {"screens": 0, "evaluations": 0, "evaluated_at": None}
+
+        # 相同条件只调用一次AI
+        groups: Dict[Tuple[str, int, int], List[Dict]] = {}
+        for screen in screens:
+            groups.setdefault(screen_key(screen), []).append(screen)
+
+        # 一次读取行情，按各筛选的分析数量截取
+        max_count = max(key[2] for key in groups)
+        stocks = await loop.run_in_executor(
+            None, partial(self.stock_fetcher.get_stocks_summary, max_count=max_count)
+        )
+        market_version = self.stock_fetcher.get_snapshot_version()
+        evaluated_at = datetime.now().isoformat(timespec="seconds")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def evaluate(key: Tuple[str, int, int]) -> Dict:
+            criteria, max_results, max_stocks_to_analyze = key
+            if not stocks:
+                return {
+                    "success": False,
+                    "error": "获取股票数据失败",
+                    "stocks": [],
+                    "analysis": ""
+                }
+            async with semaphore:
+                return await loop.run_in_executor(
+                    None,
+                    partial(
+                        self.ai_screener.screen_stocks,
+                        stocks=stocks[:max_stocks_to_analyze],
+                        criteria=criteria,
+                        max_results=max_results,
+                        # 批量重算只受全局预算约束，不占用单个客户端的额度
+                        client_id=None
+                    )
+                )
+
+        keys = list(groups)
+        outcomes = await asyncio.gather(*(evaluate(key) for key in keys))
+
+        results = {}
+        for key, outcome in zip(keys, outcomes):
+            for screen in groups[key]:
+                results[screen["id"]] = outcome
+        await loop.run_in_executor(
+            None, partial(self.store.save_results, results, evaluated_at)
+        )
+
+        return {
+            "screens": len(screens),
+            "evaluations": len(keys),
+            "failed": sum(1 for outcome in outcomes if not outcome.get("success")),
+            "evaluated_at": evaluated_at,
+            "market_version": market_version
+        }
+
+    async def _check_market_version(self):
+        """行情快照版本变化时重算（读取快照时若已过期会触发刷新）"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.stock_fetcher.get_market_snapshot)
+        version = self.stock_fetcher.get_snapshot_version()
+        if version is None or version == self._last_version:
+            return
+        summary = await self.run_batch()
+        if not summary.get("skipped"):
+            self._last_version = summary.get("market_version", version)
+
+    async def _loop(self):
+        """定期检查行情快照版本，每个新版本重算一次"""
+        while True:
+            try:
+                if self._is_leader():
+                    await self._check_market_version()
+            except Exception as e:
+                print(f"批量重算保存的筛选失败: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """启动后台重算任务"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """停止后台重算任务"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._leader_file is not None:
+            self._leader_file.close()
+            self._leader_file = None
+        self._last_version: Optional[int] = None
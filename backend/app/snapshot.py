@@ -0,0 +1,208 @@
+"""
+行情快照共享模块
+将行情 DataFrame 按列写入内存映射文件，多个 worker 进程共享同一份只读缓冲区
+文件结构：魔数 + 头部长度 + JSON 头部（版本、行数、各列类型与偏移） + 按 64 字节对齐的列数据
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Optional
+import numpy as np
+import pandas as pd
+
+# 文件锁仅在类 Unix 系统可用，不可用时各进程各自刷新
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAGIC = b"GWSNAP1\0"
+ALIGNMENT = 64
+
+
+def default_snapshot_path() -> str:
+    """默认快照路径：优先使用 /dev/shm（内存文件系统）"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "galway_market_snapshot.bin")
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class SharedSnapshot:
+    """多进程共享的列式行情快照"""
+
+    def __init__(self, path: str = "", ttl: int = 60):
+        """
+        Args:
+            path: 快照文件路径，为空时使用默认路径
+            ttl: 快照有效期（秒），过期后由任一进程刷新
+        """
+        self.path = path or default_snapshot_path()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._file_id = None
+        self._header: Optional[Dict] = None
+        self._columns: Optional[Dict[str, np.ndarray]] = None
+
+    @staticmethod
+    def _to_array(series: pd.Series) -> np.ndarray:
+        """数值列转为 float64，其余列转为定长字符串"""
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            return series.to_numpy(dtype=np.float64, na_value=np.nan)
+        return series.fillna("").astype(str).to_numpy(dtype=str)
+
+    def publish(self, df: pd.DataFrame) -> int:
+        """
+        写入新版本快照（先写临时文件再原子替换，正在读取旧版本的进程不受影响）
+        Returns:
+            新版本号
+        """
+        arrays = {str(name): self._to_array(df[name]) for name in df.columns}
+        version = (self._read_header() or {}).get("version", 0) + 1
+
+        columns = []
+        offset = 0
+        for name, array in arrays.items():
+            columns.append({
+                "name": name,
+                "dtype": array.dtype.str,
+                "offset": offset,
+                "length": len(array)
+            })
+            offset = _align(offset + array.nbytes)
+        header = {
+            "version": version,
+            "created_at": time.time(),
+            "rows": len(df),
+            "columns": columns
+        }
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+            for column, array in zip(columns, arrays.values()):
+                f.seek(data_start + column["offset"])
+                f.write(array.tobytes())
+            f.truncate(data_start + offset)
+        os.replace(tmp_path, self.path)
+        return version
+
+    def _read_header(self) -> Optional[Dict]:
+        """只读取头部，用于判断版本与是否过期"""
+        try:
+            with open(self.path, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    return None
+                (length,) = struct.unpack("<Q", f.read(8))
+                return json.loads(f.read(length).decode("utf-8"))
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def _map(self) -> bool:
+        """文件变化时重新映射，返回是否有可用快照"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        file_id = (stat.st_ino, stat.st_mtime_ns)
+        if file_id == self._file_id:
+            return True
+
+        try:
+            with open(self.path, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        if buffer[:len(MAGIC)] != MAGIC:
+            return False
+        (length,) = struct.unpack_from("<Q", buffer, len(MAGIC))
+        header_start = len(MAGIC) + 8
+        header = json.loads(buffer[header_start:header_start + length].decode("utf-8"))
+        data_start = _align(header_start + length)
+
+        # 各列直接引用映射内存，不复制；旧映射在不再被引用后释放
+        columns = {}
+        for column in header["columns"]:
+            columns[column["name"]] = np.frombuffer(
+                buffer,
+                dtype=np.dtype(column["dtype"]),
+                count=column["length"],
+                offset=data_start + column["offset"]
+            )
+        self._file_id = file_id
+        self._header = header
+        self._columns = columns
+        return True
+
+    def _is_fresh(self) -> bool:
+        return (
+            self._header is not None
+            and time.time() - self._header["created_at"] < self.ttl
+        )
+
+    def get_columns(self, fetch: Callable[[], pd.DataFrame]) -> Dict[str, np.ndarray]:
+        """
+        获取快照各列（只读数组），过期时调用 fetch 刷新
+        刷新期间其他线程与其他进程继续读取旧版本，只有尚无快照时才等待
+        Args:
+            fetch: 获取最新行情 DataFrame 的函数
+        Returns:
+            列名 -> 数组
+        """
+        with self._lock:
+            if self._map() and self._is_fresh():
+                return self._columns
+            stale = self._columns
+
+        # 同一进程内只有一个线程刷新
+        if not self._refresh_lock.acquire(blocking=stale is None):
+            return stale
+        try:
+            self._refresh(fetch, wait=stale is None)
+        finally:
+            self._refresh_lock.release()
+
+        with self._lock:
+            self._map()
+            return self._columns or {}
+
+    def _refresh(self, fetch: Callable[[], pd.DataFrame], wait: bool):
+        """
+        多进程同时发现过期时只有取得文件锁的进程刷新
+        Args:
+            wait: 文件锁被占用时是否等待（尚无可用快照时）
+        """
+        with open(f"{self.path}.lock", "w") as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    if not wait:
+                        return
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            # 取得锁后再确认一次，避免重复刷新
+            with self._lock:
+                if self._map() and self._is_fresh():
+                    return
+
+            # 获取行情期间不持有线程锁
+            df = fetch()
+            if df is not None and not df.empty:
+                self.publish(df)
+
+    @property
+    def version(self) -> Optional[int]:
+        """当前映射的快照版本"""
+        return self._header["version"] if self._header else None
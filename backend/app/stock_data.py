@@ -2,10 +2,13 @@
 A股数据获取模块
 使用 akshare 获取A股市场数据，如果不可用则使用模拟数据
 """
+import numpy as np
 import pandas as pd
 from typing import List, Dict, Optional
 from datetime import datetime
 import random
+from .config import get_settings
+from .snapshot import SharedSnapshot
 
 # 尝试导入 akshare，如果失败则使用模拟数据
 try:
@@ -15,6 +18,10 @@ except ImportError:
     AKSHARE_AVAILABLE = False
     print("⚠️  akshare 未安装，将使用模拟数据进行演示")
 
+# 行情快照，同一台机器上的所有 worker 共享
+_settings = get_settings()
+market_snapshot = SharedSnapshot(path=_settings.snapshot_path, ttl=_settings.snapshot_ttl)
+
 
 class StockDataFetcher:
     """A股数据获取器"""
@@ -56,6 +63,24 @@ class StockDataFetcher:
             print(f"获取股票列表失败: {e}，使用模拟数据")
             return StockDataFetcher._get_mock_stocks()
 
+    @staticmethod
+    def get_market_snapshot() -> Dict[str, np.ndarray]:
+        """
+        获取共享行情快照，过期时自动刷新
+        Returns:
+            列名 -> 只读数组（直接映射共享内存，不可修改）
+        """
+        return market_snapshot.get_columns(StockDataFetcher.get_all_stocks)
+
+    @staticmethod
+    def get_snapshot_version() -> Optional[int]:
+        """
+        获取本进程当前映射的行情快照版本，每次刷新行情版本号加一
+        Returns:
+            版本号，尚未读取过快照时返回 None
+        """
+        return market_snapshot.version
+
     @staticmethod
     def get_stock_info(stock_code: str) -> Optional[Dict]:
         """
@@ -129,31 +154,40 @@ class StockDataFetcher:
             股票摘要列表
         """
         try:
-            df = StockDataFetcher.get_all_stocks()
-            if df.empty:
+            columns = StockDataFetcher.get_market_snapshot()
+            if not columns:
                 return []
 
-            # 限制数量
-            df = df.head(max_count)
+            # 限制数量，只复制需要的行
+            count = min(max_count, len(next(iter(columns.values()))))
+
+            def text(name: str) -> List[str]:
+                if name not in columns:
+                    return [""] * count
+                return columns[name][:count].astype(str).tolist()
+
+            def number(name: str) -> List[float]:
+                if name not in columns:
+                    return [0.0] * count
+                values = pd.to_numeric(columns[name][:count], errors="coerce")
+                return np.nan_to_num(np.asarray(values, dtype=np.float64), nan=0.0).tolist()
+
+            fields = {
+                "code": text('代码'),
+                "name": text('名称'),
+                "price": number('最新价'),
+                "change_pct": number('涨跌幅'),
+                "volume": number('成交量'),
+                "amount": number('成交额'),
+                "turnover_rate": number('换手率'),
+                "pe_dynamic": number('市盈率-动态'),
+                "pb": number('市净率'),
+                "market_cap": number('总市值'),
+            }
 
             # 转换为字典列表
-            stocks = []
-            for _, row in df.iterrows():
-                stock_dict = {
-                    "code": str(row.get('代码', '')),
-                    "name": str(row.get('名称', '')),
-                    "price": float(row.get('最新价', 0)) if pd.notna(row.get('最新价')) else 0,
-                    "change_pct": float(row.get('涨跌幅', 0)) if pd.notna(row.get('涨跌幅')) else 0,
-                    "volume": float(row.get('成交量', 0)) if pd.notna(row.get('成交量')) else 0,
-                    "amount": float(row.get('成交额', 0)) if pd.notna(row.get('成交额')) else 0,
-                    "turnover_rate": float(row.get('换手率', 0)) if pd.notna(row.get('换手率')) else 0,
-                    "pe_dynamic": float(row.get('市盈率-动态', 0)) if pd.notna(row.get('市盈率-动态')) else 0,
-                    "pb": float(row.get('市净率', 0)) if pd.notna(row.get('市净率')) else 0,
-                    "market_cap": float(row.get('总市值', 0)) if pd.notna(row.get('总市值')) else 0,
-                }
-                stocks.append(stock_dict)
-
-            return stocks
+            keys = list(fields)
+            return [dict(zip(keys, values)) for values in zip(*fields.values())]
         except Exception as e:
             print(f"获取股票摘要失败: {e}")
             return []
@@ -4,6 +4,8 @@ API 测试脚本
 """
 import requests
 import json
+import os
+import tempfile
 
 BASE_URL = "http://localhost:8000"
 
@@ -55,6 +57,15 @@ def test_screen_stocks():
             print(f"✅ AI筛选成功，找到 {len(data.get('stocks', []))} 只股票")
             if data.get('stocks'):
                 print(f"   最佳推荐：{data['stocks'][0].get('name')} - 评分 {data['stocks'][0].get('score')}")
+            print(f"   结果来源：{data.get('engine')}")
+            if data.get('engine') not in ("deepseek", "local"):
+                print("❌ 缺少结果来源 engine 字段")
+                return False
+            if data.get('engine') == "local":
+                print(f"   降级原因：{data.get('fallback_reason')}")
+                if not data.get('fallback_reason'):
+                    print("❌ 本地排序结果缺少 fallback_reason 字段")
+                    return False
             return True
         else:
             print(f"⚠️  AI筛选返回失败: {data.get('error', '未知错误')}")
@@ -91,15 +102,362 @@ def test_chat():
         return False
 
 
+def test_saved_screens():
+    """测试保存的筛选与批量重算"""
+    print("\n测试保存的筛选...")
+    try:
+        payload = {
+            "name": "测试-低估值",
+            "criteria": "帮我找市盈率低于30的股票",
+            "max_results": 3,
+            "max_stocks_to_analyze": 20
+        }
+        response = requests.post(f"{BASE_URL}/api/screens", json=payload)
+        screen = response.json()["screen"]
+
+        response = requests.get(f"{BASE_URL}/api/screens")
+        if screen["id"] not in [s["id"] for s in response.json().get("screens", [])]:
+            print("❌ 保存的筛选未出现在列表中")
+            return False
+
+        response = requests.post(f"{BASE_URL}/api/screens/run", timeout=120)
+        print(f"   批量重算：{response.json()}")
+
+        response = requests.get(f"{BASE_URL}/api/screens/{screen['id']}/latest")
+        data = response.json()
+        requests.delete(f"{BASE_URL}/api/screens/{screen['id']}")
+
+        if response.status_code == 200 and data.get("evaluated_at"):
+            print(f"✅ 保存的筛选成功，重算时间 {data['evaluated_at']}，结果来源 {data.get('engine')}")
+            return True
+        else:
+            print(f"❌ 获取重算结果失败: {data}")
+            return False
+    except Exception as e:
+        print(f"❌ 保存的筛选失败: {e}")
+        return False
+
+
+def test_usage():
+    """测试 token 用量汇总与请求参数校验"""
+    print("\n测试 token 用量...")
+    try:
+        response = requests.get(f"{BASE_URL}/api/usage")
+        data = response.json()
+        if "clients" in data or "tokens_last_minute" not in data:
+            print(f"❌ 用量接口应只返回汇总数据: {data}")
+            return False
+        print(f"✅ 最近一分钟 token 用量 {data['tokens_last_minute']}，活跃客户端 {data['active_clients']}")
+
+        response = requests.post(
+            f"{BASE_URL}/api/screen",
+            json={"criteria": "任意", "max_stocks_to_analyze": -3}
+        )
+        if response.status_code != 422:
+            print(f"❌ 非法的分析数量应被拒绝，实际状态码 {response.status_code}")
+            return False
+        print("✅ 非法的分析数量已被拒绝")
+        return True
+    except Exception as e:
+        print(f"❌ token 用量测试失败: {e}")
+        return False
+
+
+def test_token_budget():
+    """本地检查：token 预算预留不会超出上限"""
+    print("\n检查 token 预算...")
+    try:
+        from app.budget import TokenBudget
+
+        budget = TokenBudget(per_minute=100000, per_client_per_minute=40000)
+        reservations = [budget.try_reserve(16000, "c") for _ in range(6)]
+        granted = sum(1 for r in reservations if r is not None)
+        if granted != 2:
+            print(f"❌ 客户端上限 40000 下应只允许 2 次 16000 的预留，实际 {granted} 次")
+            return False
+        if budget.try_reserve(16000, "other") is None:
+            print("❌ 其他客户端不应受影响")
+            return False
+
+        budget.settle(reservations[0], 1000)
+        if budget.try_reserve(16000, "c") is None:
+            print("❌ 按实际用量结算后应释放余量")
+            return False
+        if budget.usage()["tokens_last_minute"] != 1000 + 16000 * 3:
+            print(f"❌ 用量统计错误: {budget.usage()}")
+            return False
+
+        print("✅ token 预算检查通过")
+        return True
+    except Exception as e:
+        print(f"❌ token 预算检查失败: {e}")
+        return False
+
+
+def test_plan_tokens():
+    """本地检查：按 token 预算调整候选数量与输出上限"""
+    print("\n检查 token 规划...")
+    try:
+        os.environ.setdefault("DEEPSEEK_API_KEY", "test")
+        from app.ai_screener import AIStockScreener
+        from app.budget import TokenBudget
+
+        screener = AIStockScreener()
+        screener.max_tokens_per_request = 0
+        screener.token_budget = TokenBudget(per_minute=0, per_client_per_minute=20000)
+        stocks = [
+            {"code": f"{600000 + i}", "name": "测试股份", "price": 10.5, "change_pct": 1.2,
+             "turnover_rate": 2.3, "pe_dynamic": 15.2, "pb": 1.3, "market_cap": 1e10}
+            for i in range(300)
+        ]
+
+        full = screener._plan_tokens(stocks, "低估值", 10, "c")
+        if full[0] != screener.MAX_PROMPT_STOCKS:
+            print(f"❌ 预算充足时应使用全部候选: {full}")
+            return False
+
+        screener.max_tokens_per_request = 3000
+        small = screener._plan_tokens(stocks, "低估值", 10, "c")
+        if not 0 < small[0] < full[0]:
+            print(f"❌ 单次请求上限应减少候选数量: {small}")
+            return False
+
+        screener.token_budget.try_reserve(20000, "c")
+        if screener._plan_tokens(stocks, "低估值", 10, "c") is not None:
+            print("❌ 客户端预算用尽时应返回 None")
+            return False
+        if screener._plan_tokens(stocks, "低估值", 10, "fresh") is None:
+            print("❌ 其他客户端不应受影响")
+            return False
+
+        print(f"✅ token 规划检查通过（候选 {full[0]} -> {small[0]}）")
+        return True
+    except Exception as e:
+        print(f"❌ token 规划检查失败: {e}")
+        return False
+
+
+def test_client_id():
+    """本地检查：客户端标识不能通过伪造 X-Forwarded-For 绕过"""
+    print("\n检查客户端标识...")
+    try:
+        os.environ.setdefault("DEEPSEEK_API_KEY", "test")
+        from starlette.requests import Request
+        from app import main
+
+        def request(host, forwarded=None):
+            headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+            return Request({"type": "http", "client": (host, 12345), "headers": headers})
+
+        original = main.settings.trusted_proxies
+        main.settings.trusted_proxies = "10.0.0.1,10.0.0.2"
+        try:
+            cases = [
+                # 非可信来源：忽略请求头
+                (request("1.2.3.4", "5.6.7.8"), "1.2.3.4"),
+                # 经可信代理：取代理追加的真实地址
+                (request("10.0.0.1", "1.2.3.4"), "1.2.3.4"),
+                # 客户端伪造的前置条目被忽略
+                (request("10.0.0.1", "9.9.9.9, 1.2.3.4"), "1.2.3.4"),
+                # 多级可信代理
+                (request("10.0.0.1", "9.9.9.9, 1.2.3.4, 10.0.0.2"), "1.2.3.4"),
+                # 没有请求头时使用代理地址
+                (request("10.0.0.1"), "10.0.0.1"),
+            ]
+            for http_request, expected in cases:
+                client_id = main.get_client_id(http_request)
+                if client_id != expected:
+                    print(f"❌ 客户端标识错误: {http_request.headers.get('x-forwarded-for')} -> {client_id}，应为 {expected}")
+                    return False
+        finally:
+            main.settings.trusted_proxies = original
+
+        print("✅ 客户端标识检查通过")
+        return True
+    except Exception as e:
+        print(f"❌ 客户端标识检查失败: {e}")
+        return False
+
+
+def test_local_ranker():
+    """本地检查：本地多因子排序"""
+    print("\n检查本地多因子排序...")
+    try:
+        import pandas as pd
+        from app.local_ranker import LocalStockRanker
+
+        def stock(code, pe, pb, market_cap):
+            return {
+                "code": code, "name": code, "price": 10, "change_pct": 1,
+                "turnover_rate": 1, "amount": 1e8,
+                "pe_dynamic": pe, "pb": pb, "market_cap": market_cap
+            }
+
+        stocks = [
+            stock("loss", -5, -1, 5e9),
+            stock("cheap", 5, 0.8, 5e9),
+            stock("mid", 20, 2, 5e9),
+            stock("dear", 60, 8, 5e9),
+            stock("nocap", 10, 1, 0),
+        ]
+        ranker = LocalStockRanker()
+
+        result = ranker.screen_stocks(stocks, "低估值", max_results=5)
+        codes = [s["code"] for s in result["stocks"]]
+        if result.get("engine") != "local" or codes[0] != "cheap" or codes[-1] != "loss":
+            print(f"❌ 估值排序错误: {codes}")
+            return False
+        if "-5.0" in result["stocks"][-1]["reason"]:
+            print(f"❌ 亏损股理由不应显示市盈率数值: {result['stocks'][-1]['reason']}")
+            return False
+
+        # 分析说明应反映实际的降级原因
+        result = ranker.screen_stocks(stocks, "低估值", max_results=3, reason="本分钟 token 预算不足")
+        if "本分钟 token 预算不足" not in result["analysis"] or "不可用" in result["analysis"]:
+            print(f"❌ 分析说明与降级原因不符: {result['analysis']}")
+            return False
+
+        factors = ranker._factor_scores(pd.DataFrame(stocks), prefer_small=True)
+        if factors["size"][4] != 0 or factors["value"][1] != 1.0:
+            print(f"❌ 因子得分错误: 规模 {factors['size'].tolist()} 估值 {factors['value'].tolist()}")
+            return False
+
+        print("✅ 本地多因子排序检查通过")
+        return True
+    except Exception as e:
+        print(f"❌ 本地多因子排序检查失败: {e}")
+        return False
+
+
+def test_shared_snapshot():
+    """本地检查：共享行情快照的发布、版本切换与读取"""
+    print("\n检查共享行情快照...")
+    try:
+        import pandas as pd
+        from app import stock_data
+        from app.snapshot import SharedSnapshot
+        from app.stock_data import StockDataFetcher
+
+        def iterrows_summary(df):
+            """原 get_stocks_summary 的逐行转换，作为对照"""
+            def number(row, name):
+                value = row.get(name)
+                return float(value) if pd.notna(value) else 0
+
+            return [{
+                "code": str(row.get('代码', '')),
+                "name": str(row.get('名称', '')),
+                "price": number(row, '最新价'),
+                "change_pct": number(row, '涨跌幅'),
+                "volume": number(row, '成交量'),
+                "amount": number(row, '成交额'),
+                "turnover_rate": number(row, '换手率'),
+                "pe_dynamic": number(row, '市盈率-动态'),
+                "pb": number(row, '市净率'),
+                "market_cap": number(row, '总市值'),
+            } for _, row in df.iterrows()]
+
+        first = StockDataFetcher._get_mock_stocks()
+        second = first.copy()
+        second['最新价'] = second['最新价'] + 1
+        # 缺失值与 object 类型的数值列
+        second.loc[0, '市盈率-动态'] = None
+        second['市净率'] = second['市净率'].astype(object)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "snapshot.bin")
+            writer = SharedSnapshot(path, ttl=3600)
+            reader = SharedSnapshot(path, ttl=3600)
+
+            v1 = writer.publish(first)
+            old = reader.get_columns(lambda: None)
+            v2 = writer.publish(second)
+            if v2 <= v1:
+                print(f"❌ 版本号应递增: {v1} -> {v2}")
+                return False
+
+            columns = reader.get_columns(lambda: None)
+            if reader.version != v2:
+                print(f"❌ 其他实例应读取到新版本 {v2}，实际 {reader.version}")
+                return False
+            if any(array.flags.writeable for array in columns.values()):
+                print("❌ 快照数组应为只读")
+                return False
+            if old['最新价'][0] != first['最新价'][0]:
+                print("❌ 切换版本后旧版本数组应仍可读取")
+                return False
+
+            original = stock_data.market_snapshot
+            stock_data.market_snapshot = reader
+            try:
+                summary = StockDataFetcher.get_stocks_summary(max_count=7)
+            finally:
+                stock_data.market_snapshot = original
+            if summary != iterrows_summary(second.head(7)):
+                print("❌ get_stocks_summary 与逐行转换结果不一致")
+                return False
+
+        print("✅ 共享行情快照检查通过")
+        return True
+    except Exception as e:
+        print(f"❌ 共享行情快照检查失败: {e}")
+        return False
+
+
+def test_saved_screen_store_shared():
+    """本地检查：多个 worker 共用同一存储文件时互相可见且不会覆盖"""
+    print("\n检查保存的筛选存储（多实例）...")
+    try:
+        from app.saved_screens import SavedScreenStore
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "screens.json")
+            store_a = SavedScreenStore(path)
+            store_b = SavedScreenStore(path)
+
+            screen = store_a.create("a", "低估值")
+            if store_b.get(screen["id"]) is None:
+                print("❌ 实例 A 新建的筛选在实例 B 中不可见")
+                return False
+
+            store_b.save_results({}, "t0")
+            store_b.save_results({screen["id"]: {"success": True, "stocks": []}}, "t1")
+            if store_a.get(screen["id"]) is None or store_a.get_latest(screen["id"]) is None:
+                print("❌ 实例 B 写入后实例 A 的数据丢失")
+                return False
+
+            # 重算失败时保留上一次成功的结果
+            store_a.save_results({screen["id"]: {"success": False, "error": "boom"}}, "t2")
+            latest = store_b.get_latest(screen["id"])
+            if latest.get("evaluated_at") != "t1" or latest.get("last_error") != "boom":
+                print(f"❌ 重算失败不应覆盖上次成功的结果: {latest}")
+                return False
+
+        print("✅ 保存的筛选存储检查通过")
+        return True
+    except Exception as e:
+        print(f"❌ 保存的筛选存储检查失败: {e}")
+        return False
+
+
 if __name__ == "__main__":
     print("=" * 50)
     print("DeepSeek AI 炒股平台 - API 测试")
     print("=" * 50)
 
-    # 运行测试
+    # 本地检查（无需启动服务）
     results = []
+    results.append(("保存的筛选存储", test_saved_screen_store_shared()))
+    results.append(("本地多因子排序", test_local_ranker()))
+    results.append(("token 预算", test_token_budget()))
+    results.append(("token 规划", test_plan_tokens()))
+    results.append(("客户端标识", test_client_id()))
+    results.append(("共享行情快照", test_shared_snapshot()))
+
+    # 运行测试
     results.append(("健康检查", test_health()))
     results.append(("获取股票列表", test_get_stocks()))
+    results.append(("token 用量", test_usage()))
 
     # 提示：AI相关测试需要配置API Key
     print("\n" + "=" * 50)
@@ -108,6 +466,7 @@ if __name__ == "__main__":
 
     results.append(("AI筛选", test_screen_stocks()))
     results.append(("股票问答", test_chat()))
+    results.append(("保存的筛选", test_saved_screens()))
 
     # 总结
     print("\n" + "=" * 50)